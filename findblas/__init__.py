@@ -1,17 +1,44 @@
-import os, sys, re, warnings
+import os, sys, re, warnings, json, hashlib, tempfile
 from sys import platform
 from sysconfig import get_paths
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 import platform as platform_module
-try:
-	import numpy as np
-	import numpy.distutils.system_info
-except:
-	pass
-try:
-	import scipy
-	import scipy.linalg
-except:
-	pass
+
+## Patterns used for scanning symbol tables and package metadata
+_RE_OPENBLAS = re.compile(b"openblas")
+_RE_MKL_DCSRGEMV = re.compile(b"mkl_dcsrgemv")
+_RE_DDOT_US = re.compile(rb"ddot_(?![a-z])")
+_RE_CBLAS_DDOT = re.compile(b"cblas_ddot")
+_RE_DDOT = re.compile(b"ddot")
+_RE_READELF_UNDEF = re.compile(rb"\sUND\s")
+_RE_MKL_RT = re.compile(r"mkl_rt\.[solibdyaSOLIBDYA]+$")
+_RE_PIP_SHOW_MKL = re.compile(r"^(?:Location:\s+(?P<loc>.+?)|\s*(?:(?P<fold>.*)[/\\]+)?[lib]*mkl_rt\.[solibdyaSOLIBDYA]+)\s*$", re.MULTILINE)
+
+## Sub-folders to look up in PEP518 environments, relative to their root folder
+## (folder names are given as tuples to be passed to 'os.path.join')
+_PEP518_LIB_ROOTS = ("lib", "Lib")
+_PEP518_LIB_SUBDIRS = ((), ("gsl",), ("gsl", "lib"), ("gslcblas",), ("cblas",), ("blas",),
+	("mkl",), ("mkl", "lib"), ("mkl", "lib", "intel"),
+	("atlas",), ("atlas", "lib"), ("libatlas",), ("libatlas", "lib"))
+_PEP518_LIB_INCLUDES = (("gsl", ("gsl", "include")), ("mkl", ("mkl", "include")),
+	("atlas", ("atlas", "include")), ("atlas", ("libatlas", "include")))
+_PEP518_INCLUDE_SUBDIRS = (("system", ()), ("gsl", ("gsl",)), ("gsl", ("gsl", "include")), ("gsl", ("gslcblas",)),
+	("system", ("cblas",)), ("system", ("blas",)),
+	("mkl", ("mkl",)), ("mkl", ("mkl", "lib")), ("mkl", ("mkl", "lib", "intel")), ("mkl", ("mkl", "include")),
+	("atlas", ("atlas",)), ("atlas", ("atlas", "include")), ("atlas", ("libatlas",)))
+
+## Increase whenever the lookup logic changes, so that old cached results are not reused
+_RESULT_CACHE_VERSION = 1
+## Cache files beyond this many are deleted, least recently used first
+_RESULT_CACHE_MAX_FILES = 8
+
+## Optional modules, imported only when they are needed (numpy and scipy are slow to import)
+_optional_modules = None
+_elffile_class = None
+
+## Directory listings are cached during a single 'find_blas' call, as {folder : {name : os.DirEntry}}
+_dir_cache = dict()
 
 def find_blas():
 	"""
@@ -27,6 +54,11 @@ def find_blas():
 
 	Does not have any external dependencies, but the following are recommended: numpy, scipy, pyelftools, cython.
 
+	The result is saved to a cache file (under '~/.cache/findblas', or '%LOCALAPPDATA%\\findblas' in Windows) and reused
+	in later calls from the same python environment, for as long as neither the files that were found nor any of the
+	folders that were searched have been modified. Results without a header are not saved.
+	Set the environment variable 'FINDBLAS_NO_CACHE=1' to always do a fresh lookup.
+
 	Returns
 	-------
 	blas_path : str
@@ -48,6 +80,19 @@ def find_blas():
 		- HAS_UNDERSCORES (found library contains functions with original names ending in underscores, e.g. 'dgemm_').
 	"""
 	
+	cache_file = _result_cache_file()
+	cached_result = _load_cached_result(cache_file)
+	if cached_result is not None:
+		return cached_result
+
+	## the folder listings are only kept for the duration of the lookup, also if it fails
+	_dir_cache.clear()
+	try:
+		return _search_blas(cache_file)
+	finally:
+		_dir_cache.clear()
+
+def _search_blas(cache_file):
 	if platform[:3] == "win":
 		ext = [".lib", ".dll", ".dll.a", ".a"]
 		pref = ""
@@ -260,105 +305,48 @@ def find_blas():
 			pass
 
 	## Potential cases of PEP518 environments
+	pep518_include_paths = {"system" : system_include_paths, "mkl" : mkl_include_paths,
+		"atlas" : atlas_include_paths, "gsl" : gsl_include_paths}
+	## (many candidate paths share the same root, which only needs to be expanded once)
+	pep518_roots = dict.fromkeys(re.sub(r"^(.*[Oo]verlay).*$", r"\1", path)
+		for path in candidate_paths if bool(re.search(r"[Oo]verlay", path)))
 	paths_pep518 = []
-	for path in candidate_paths:
-		if bool(re.search(r"[Oo]verlay", path)):
-			clean_path = re.sub(r"^(.*[Oo]verlay).*$", r"\1", path)
-
-			paths_pep518.append(clean_path)
-
-			paths_pep518.append(os.path.join(clean_path, "lib"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "gsl"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "gsl", "lib"))
-			gsl_include_paths.append(os.path.join(clean_path, "lib", "gsl", "include"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "gslcblas"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "cblas"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "blas"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "mkl"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "mkl", "lib"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "mkl", "lib", "intel"))
-			mkl_include_paths.append(os.path.join(clean_path, "lib", "mkl", "include"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "atlas"))
-			atlas_include_paths.append(os.path.join(clean_path, "lib", "atlas", "include"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "atlas", "lib"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "libatlas"))
-			atlas_include_paths.append(os.path.join(clean_path, "lib", "libatlas", "include"))
-			paths_pep518.append(os.path.join(clean_path, "lib", "libatlas", "lib"))
-
-			paths_pep518.append(os.path.join(clean_path, "Lib"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "gsl"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "gsl", "lib"))
-			gsl_include_paths.append(os.path.join(clean_path, "Lib", "gsl", "include"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "gslcblas"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "cblas"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "blas"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "mkl"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "mkl", "lib"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "mkl", "lib", "intel"))
-			mkl_include_paths.append(os.path.join(clean_path, "Lib", "mkl", "include"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "atlas"))
-			atlas_include_paths.append(os.path.join(clean_path, "Lib", "atlas", "include"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "atlas", "lib"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "libatlas"))
-			atlas_include_paths.append(os.path.join(clean_path, "Lib", "libatlas", "include"))
-			paths_pep518.append(os.path.join(clean_path, "Lib", "libatlas", "lib"))
-
-			system_include_paths.append(os.path.join(clean_path, "include"))
-			gsl_include_paths.append(os.path.join(clean_path, "include", "gsl"))
-			gsl_include_paths.append(os.path.join(clean_path, "include", "gsl", "include"))
-			gsl_include_paths.append(os.path.join(clean_path, "include", "gslcblas"))
-			system_include_paths.append(os.path.join(clean_path, "include", "cblas"))
-			system_include_paths.append(os.path.join(clean_path, "include", "blas"))
-			mkl_include_paths.append(os.path.join(clean_path, "include", "mkl"))
-			mkl_include_paths.append(os.path.join(clean_path, "include", "mkl", "lib"))
-			mkl_include_paths.append(os.path.join(clean_path, "include", "mkl", "lib", "intel"))
-			mkl_include_paths.append(os.path.join(clean_path, "include", "mkl", "include"))
-			atlas_include_paths.append(os.path.join(clean_path, "include", "atlas"))
-			atlas_include_paths.append(os.path.join(clean_path, "include", "atlas", "include"))
-			atlas_include_paths.append(os.path.join(clean_path, "include", "libatlas"))
-			atlas_include_paths.append(os.path.join(clean_path, "lib", "libatlas", "include"))
+	for clean_path in pep518_roots:
+		paths_pep518.append(clean_path)
+		for lib_fold in _PEP518_LIB_ROOTS:
+			paths_pep518.extend(os.path.join(clean_path, lib_fold, *subdirs) for subdirs in _PEP518_LIB_SUBDIRS)
+			for lib_name, subdirs in _PEP518_LIB_INCLUDES:
+				pep518_include_paths[lib_name].append(os.path.join(clean_path, lib_fold, *subdirs))
+		for lib_name, subdirs in _PEP518_INCLUDE_SUBDIRS:
+			pep518_include_paths[lib_name].append(os.path.join(clean_path, "include", *subdirs))
 
 	candidate_paths += paths_pep518
 
-	## Try getting MKL from pip too
-	try:
-		import pip
-		import io
-		from contextlib import redirect_stdout
-
-		pip_outp = io.StringIO()
+	## Try getting MKL from the dynamic loader's search path (gives full paths in Windows and macOS),
+	## or otherwise from the python package metadata
+	mkl_from_loader = _find_library_path("mkl_rt")
+	if mkl_from_loader is not None:
+		candidate_paths.append(os.path.dirname(mkl_from_loader))
+	else:
 		try:
+			from importlib.metadata import distribution, PackageNotFoundError
+		except ImportError:
+			_add_mkl_paths_from_pip(candidate_paths)
+		else:
 			try:
-				with redirect_stdout(pip_outp):
-					pip.main(['show', '-f', 'mkl'])
-			except:
-				from pip._internal import main as pip_main
-				with redirect_stdout(pip_outp):
-					pip_main(['show', '-f', 'mkl'])
-		except:
-			with redirect_stdout(pip_outp):
-				os.system("pip show -f mkl")
-
-		pip_outp = pip_outp.getvalue()
-		pip_outp = pip_outp.split("\n")
-		for ln in pip_outp:
-			if bool(re.search(r"^Location", ln)):
-				files_root = re.sub(r"^Location:\s+", "", ln)
-				files_root = files_root.rstrip()
-				break
-
-		for ln in pip_outp:
-			## exts: .o, .so, .a, .lib, .dll, .dynlib
-			if bool(re.search(r"mkl_rt\.[solibdyaSOLIBDYA]+$", ln)):
-				candidate_paths.append(
-					os.path.join(files_root, re.sub(r"^\s*(.*)[/\\]+[lib]*mkl_rt\.[solibdyaSOLIBDYA]+$", r"\1", ln))
-				)
-
-	except:
-		pass
+				mkl_dist = distribution("mkl")
+				for fpath in (mkl_dist.files or []):
+					## exts: .o, .so, .a, .lib, .dll, .dynlib
+					if _RE_MKL_RT.search(fpath.name) is not None:
+						candidate_paths.append(os.path.dirname(os.path.normpath(str(mkl_dist.locate_file(fpath)))))
+			except PackageNotFoundError:
+				pass
 
 	## Discard duplicated paths, but keep the order
 	search_paths = _deduplicate_paths(candidate_paths)
+	_prefetch_dirs(search_paths)
+	## a cached result is only valid while none of the searched folders changes
+	searched_folders = list(search_paths)
 
 	flags_found = list()
 	blas_file = None
@@ -366,72 +354,39 @@ def find_blas():
 
 	### Start looking for each library in selected paths
 	def search_blas_lib(search_paths, blas_names):
-		blas_path = None
-		blas_file = None
 		for blas_name in blas_names:
-			if blas_file is None:
-				for pt in search_paths:
-					if os.path.exists(os.path.join(pt, blas_name)):
-						blas_file = blas_name
-						blas_path = pt
-						break
-			else:
-				break
-		return blas_path, blas_file
-
-	### First try dynamic-link libraries
-	## MKL
-	if blas_file is None:
-		blas_path, blas_file = search_blas_lib(search_paths, mkl_file_names1)
-		if blas_file is not None:
-			flags_found.append("HAS_MKL")
-
-	## OpenBLAS
-	if blas_file is None:
-		blas_path, blas_file = search_blas_lib(search_paths, openblas_file_names1)
-		if blas_file is not None:
-			flags_found.append("HAS_OPENBLAS")
-			flags_found.append("HAS_UNDERSCORES")
-
-	## ATLAS
-	if blas_file is None:
-		blas_path, blas_file = search_blas_lib(search_paths, atlas_file_names1)
-		if blas_file is not None:
-			flags_found.append("HAS_ATLAS")
-			flags_found.append("HAS_UNDERSCORES")
-
-	## GSL
-	if blas_file is None:
-		blas_path, blas_file = search_blas_lib(search_paths, gsl_file_names1)
-		if blas_file is not None:
-			flags_found.append("HAS_GSL")
-
-	### Then try static libraries
-	## MKL
-	if blas_file is None:
-		blas_path, blas_file = search_blas_lib(search_paths, mkl_file_names2)
-		if blas_file is not None:
-			flags_found.append("HAS_MKL")
-
-	## OpenBLAS
-	if blas_file is None:
-		blas_path, blas_file = search_blas_lib(search_paths, openblas_file_names2)
-		if blas_file is not None:
-			flags_found.append("HAS_OPENBLAS")
-			flags_found.append("HAS_UNDERSCORES")
-
-	## ATLAS
-	if blas_file is None:
-		blas_path, blas_file = search_blas_lib(search_paths, atlas_file_names2)
-		if blas_file is not None:
-			flags_found.append("HAS_ATLAS")
-			flags_found.append("HAS_UNDERSCORES")
-
-	## GSL
-	if blas_file is None:
-		blas_path, blas_file = search_blas_lib(search_paths, gsl_file_names2)
-		if blas_file is not None:
-			flags_found.append("HAS_GSL")
+			for pt in search_paths:
+				if blas_name in _list_dir(pt):
+					return pt, blas_name
+		return None, None
+
+	def search_blas_libs(search_paths, lib_probes):
+		## Each folder is scanned once for all the file names, remembering the first
+		## folder in which each name appears - the first probe that matched is taken
+		wanted_names = set(blas_name for blas_names, lib_flags in lib_probes for blas_name in blas_names)
+		found_in = dict()
+		for pt in search_paths:
+			for blas_name in wanted_names.intersection(_list_dir(pt)):
+				found_in.setdefault(blas_name, pt)
+		for blas_names, lib_flags in lib_probes:
+			for blas_name in blas_names:
+				if blas_name in found_in:
+					return found_in[blas_name], blas_name, lib_flags
+		return None, None, []
+
+	### First try dynamic-link libraries, then static libraries
+	lib_probes = [
+		(mkl_file_names1, ["HAS_MKL"]),
+		(openblas_file_names1, ["HAS_OPENBLAS", "HAS_UNDERSCORES"]),
+		(atlas_file_names1, ["HAS_ATLAS", "HAS_UNDERSCORES"]),
+		(gsl_file_names1, ["HAS_GSL"]),
+		(mkl_file_names2, ["HAS_MKL"]),
+		(openblas_file_names2, ["HAS_OPENBLAS", "HAS_UNDERSCORES"]),
+		(atlas_file_names2, ["HAS_ATLAS", "HAS_UNDERSCORES"]),
+		(gsl_file_names2, ["HAS_GSL"])
+	]
+	blas_path, blas_file, lib_flags = search_blas_libs(search_paths, lib_probes)
+	flags_found += lib_flags
 
 	### Generic
 	if blas_file is None:
@@ -450,12 +405,11 @@ def find_blas():
 						flags_found += found_syms[1]
 
 	### Try regex matching
-	def check_is_blas(pt, fname):
+	def check_is_blas(pt, fname, found_syms):
 		ask_user = True
 		is_blas = False
 		flags_found = []
 		if platform[:3] != "win":
-			found_syms = _find_symbols(pt, fname)
 			if found_syms[0] is True:
 				if found_syms[1] is not None:
 					is_blas = True
@@ -485,25 +439,33 @@ def find_blas():
 		candidate_paths_dyna = []
 		candidate_paths_stat = []
 		for pt in search_paths:
-			if os.path.exists(pt):
-				nfound_dyna = len(candidate_files_dyna)
-				nfound_stat = len(candidate_files_stat)
-				candidate_files_dyna += [f for f in os.listdir(pt) if bool(re.search("blas", f)) and bool(re.search(r"\." + ext[0][1:] + r"$", f))]
-				candidate_files_stat += [f for f in os.listdir(pt) if bool(re.search("blas", f)) and bool(re.search(r"\." + ext[1][1:] + r"$", f))]
-				nfound_dyna = len(candidate_files_dyna) - nfound_dyna
-				nfound_stat = len(candidate_files_stat) - nfound_stat
-				candidate_paths_dyna += [pt] * nfound_dyna
-				candidate_paths_stat += [pt] * nfound_stat
+			## a single pass over each folder fills both the dynamic and the static candidates
+			for fname, entry in sorted(_list_dir(pt).items()):
+				if ("blas" not in fname.lower()) or (not entry.is_file()):
+					continue
+				if fname.endswith(ext[0]):
+					candidate_files_dyna.append(fname)
+					candidate_paths_dyna.append(pt)
+				elif fname.endswith(ext[1]):
+					candidate_files_stat.append(fname)
+					candidate_paths_stat.append(pt)
 
 		candidate_files = candidate_files_dyna + candidate_files_stat
 		candidate_paths = candidate_paths_dyna + candidate_paths_stat
-		for f in range(len(candidate_files)):
-			is_blas, temp = check_is_blas(candidate_paths[f], candidate_files[f])
-			if is_blas:
-				blas_file = candidate_files[f]
-				blas_path = candidate_paths[f]
-				flags_found += temp
-				break
+		## symbols are inspected a few files ahead concurrently, but results are still taken in
+		## the original order, and the remaining files are not inspected once one matches
+		if platform[:3] != "win":
+			candidate_syms = _imap_concurrently(_find_symbols, candidate_paths, candidate_files)
+		else:
+			candidate_syms = ((False, None) for fname in candidate_files)
+		with closing(candidate_syms):
+			for f in range(len(candidate_files)):
+				is_blas, temp = check_is_blas(candidate_paths[f], candidate_files[f], next(candidate_syms))
+				if is_blas:
+					blas_file = candidate_files[f]
+					blas_path = candidate_paths[f]
+					flags_found += temp
+					break
 
 	err_msg = "Could not locate MKL, OpenBLAS, ATLAS or GSL libraries - you'll need to manually modify setup.py to add BLAS path."
 	if blas_file is None:
@@ -551,24 +513,16 @@ def find_blas():
 		include_paths += system_include_paths
 		return _deduplicate_paths(include_paths)
 	def search_incl_kwds(search_paths, blas_names, keywords):
-		incl_file = None
-		incl_path = None
+		kwds_regex = re.compile("|".join(re.escape(kw) for kw in keywords))
 		for incl_name in blas_names:
 			for pt in search_paths:
-				if incl_file is not None:
-					break
-				if os.path.exists(os.path.join(pt, incl_name)):
+				if incl_name in _list_dir(pt):
+					## headers are small, so they can be scanned in one go
 					with open(os.path.join(pt, incl_name)) as h:
-						for line in h:
-							if incl_file is not None:
-								break
-							for kw in keywords:
-								if bool(re.search(kw, line)):
-									incl_file = incl_name
-									incl_path = pt
-									break
+						if kwds_regex.search(h.read()) is not None:
+							return pt, incl_name
 
-		return incl_path, incl_file
+		return None, None
 
 	if 'HAS_MKL' in flags_found:
 		search_paths = get_inc_paths(blas_path, mkl_include_paths, system_include_paths)
@@ -595,76 +549,336 @@ def find_blas():
 		all_kwds += ["ddot", "DDOT"]
 		incl_path, incl_file = search_incl_kwds(search_paths, incl_generic_name, all_kwds)
 
+	## a missing header might get installed later on (e.g. following the warnings from 'findblas.distutils')
+	if incl_path is not None:
+		searched_folders += [blas_path] + search_paths
+		_save_cached_result(cache_file, blas_path, blas_file, incl_path, incl_file, flags_found, searched_folders)
 	return blas_path, blas_file, incl_path, incl_file, flags_found
 
+def _result_cache_file():
+	## Cache file for the results of 'find_blas', keyed by what determines the search paths
+	if os.environ.get("FINDBLAS_NO_CACHE", "0") not in ["", "0"]:
+		return None
+	try:
+		if platform[:3] == "win":
+			cache_root = os.path.join(os.environ["LOCALAPPDATA"], "findblas")
+		else:
+			cache_root = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "findblas")
+		cache_key = (_RESULT_CACHE_VERSION, platform, sys.prefix, tuple(sys.version_info[:2]), tuple(sorted(sys.path)),
+			os.environ.get("CONDA_PREFIX"), os.environ.get("MKLROOT"), os.environ.get("BLAS"),
+			os.environ.get("PATH"), os.environ.get("PYTHONPATH"))
+		cache_hash = hashlib.sha1(repr(cache_key).encode("utf-8")).hexdigest()
+		return os.path.join(cache_root, cache_hash + ".json")
+	except:
+		return None
+
+def _folders_mtime(folders):
+	## Adding or removing a file changes the folder's modification time - folders
+	## that don't exist are recorded too, in case they get created later
+	mtimes = []
+	for fold in folders:
+		try:
+			mtimes.append(os.stat(fold).st_mtime_ns)
+		except OSError:
+			mtimes.append(None)
+	return mtimes
+
+def _files_stat(files):
+	## Symlinks are followed, so that re-pointing them (e.g. with 'update-alternatives') is noticed,
+	## as is a file overwritten in place - neither of which modifies the folder
+	stats = []
+	for fpath in files:
+		fstat = os.stat(fpath)
+		stats.append([fstat.st_ino, fstat.st_size, fstat.st_mtime_ns])
+	return stats
+
+def _load_cached_result(cache_file):
+	if cache_file is None:
+		return None
+	try:
+		with open(cache_file, "r") as f:
+			cached = json.load(f)
+		blas_path, blas_file, incl_path, incl_file, flags_found = cached["result"]
+		if _files_stat([os.path.join(blas_path, blas_file), os.path.join(incl_path, incl_file)]) != cached["files"]:
+			return None
+		if _folders_mtime(cached["folders"]) != cached["mtimes"]:
+			return None
+		## mark it as recently used, so that it is the last to be pruned
+		os.utime(cache_file)
+		return blas_path, blas_file, incl_path, incl_file, flags_found
+	except:
+		return None
+
+def _save_cached_result(cache_file, blas_path, blas_file, incl_path, incl_file, flags_found, searched_folders):
+	if cache_file is None:
+		return None
+	try:
+		searched_folders = _deduplicate_paths(searched_folders)
+		cached = {
+			"result" : [blas_path, blas_file, incl_path, incl_file, flags_found],
+			"files" : _files_stat([os.path.join(blas_path, blas_file), os.path.join(incl_path, incl_file)]),
+			"folders" : searched_folders,
+			"mtimes" : _folders_mtime(searched_folders)
+		}
+		os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+		## write to a temporary file first, so that concurrent builds never see a partial file
+		fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".tmp")
+		with os.fdopen(fd, "w") as f:
+			json.dump(cached, f)
+		os.replace(tmp_file, cache_file)
+		_prune_result_cache(os.path.dirname(cache_file))
+	except:
+		pass
+
+def _prune_result_cache(cache_root):
+	## Builds in isolated environments search random temporary folders, so each one
+	## leaves behind a cache file that will not be used again
+	cache_files = []
+	with os.scandir(cache_root) as it:
+		for entry in it:
+			if entry.name.endswith(".json") and entry.is_file():
+				cache_files.append((entry.stat().st_mtime_ns, entry.path))
+	cache_files.sort(reverse=True)
+	for mtime, fpath in cache_files[_RESULT_CACHE_MAX_FILES:]:
+		try:
+			os.remove(fpath)
+		except OSError:
+			pass
+
+def _add_mkl_paths_from_pip(candidate_paths):
+	## For python versions without 'importlib.metadata'
+	try:
+		import pip
+		import io
+		from contextlib import redirect_stdout
+
+		pip_outp = io.StringIO()
+		try:
+			try:
+				with redirect_stdout(pip_outp):
+					pip.main(['show', '-f', 'mkl'])
+			except:
+				from pip._internal import main as pip_main
+				with redirect_stdout(pip_outp):
+					pip_main(['show', '-f', 'mkl'])
+		except:
+			with redirect_stdout(pip_outp):
+				os.system("pip show -f mkl")
+
+		## a single pass over the output picks both the install location and the library folders
+		files_root = None
+		mkl_folds = []
+		for m in _RE_PIP_SHOW_MKL.finditer(pip_outp.getvalue()):
+			if m.group("loc") is not None:
+				files_root = m.group("loc")
+			else:
+				mkl_folds.append(m.group("fold") or "")
+		if files_root is not None:
+			candidate_paths += [os.path.join(files_root, fold) for fold in mkl_folds]
+
+	except:
+		pass
+
 def _deduplicate_paths(candidate_paths):
 	## Discards duplicated paths, but keep the order
-	seen_paths = set()
-	search_paths = list()
-	for pt in candidate_paths:
-		pt = re.sub(r"\\", "/", pt)
-		pt = re.sub(r"/+", "/", pt)
-		if pt not in seen_paths:
-			search_paths.append(pt)
-			seen_paths.add(pt)
-	return search_paths
+	return list(dict.fromkeys(_normalize_path(pt) for pt in candidate_paths))
+
+def _normalize_path(pt):
+	pt = pt.replace("\\", "/")
+	while "//" in pt:
+		pt = pt.replace("//", "/")
+	return pt
+
+def _list_dir(pt):
+	## Returns the entries in a folder (empty if it doesn't exist) as a dict of {name : os.DirEntry},
+	## listing each folder only once - the entries keep the file type information from the listing
+	try:
+		return _dir_cache[pt]
+	except KeyError:
+		pass
+	try:
+		with os.scandir(pt) as it:
+			files_pt = {entry.name : entry for entry in it}
+	except OSError:
+		files_pt = dict()
+	_dir_cache[pt] = files_pt
+	return files_pt
+
+def _map_concurrently(fun, *args):
+	## The work done here (listing folders, reading files, launching 'nm') is I/O-bound
+	## and releases the GIL, so threads can overlap the waits
+	n_tasks = min(len(arg) for arg in args)
+	if n_tasks <= 1:
+		return list(map(fun, *args))
+	n_threads = min(n_tasks, 32, (os.cpu_count() or 1) * 4)
+	with ThreadPoolExecutor(max_workers=n_threads) as executor:
+		return list(executor.map(fun, *args))
+
+def _imap_concurrently(fun, *args):
+	## Like '_map_concurrently', but yields the results in order as they are requested - when
+	## the generator is closed, the calls that have not started yet are cancelled
+	n_tasks = min(len(arg) for arg in args)
+	if n_tasks <= 1:
+		yield from map(fun, *args)
+		return
+	n_threads = min(n_tasks, os.cpu_count() or 1)
+	executor = ThreadPoolExecutor(max_workers=n_threads)
+	futures = [executor.submit(fun, *fun_args) for fun_args in zip(*args)]
+	try:
+		for future in futures:
+			yield future.result()
+	finally:
+		for future in futures:
+			future.cancel()
+		executor.shutdown(wait=True)
+
+def _prefetch_dirs(folders):
+	## Fills the listings cache for all the folders that will be searched
+	_map_concurrently(_list_dir, [pt for pt in folders if pt not in _dir_cache])
+
+def _find_library_path(lib_name):
+	## Only full paths are useful here - in Linux and BSDs, 'find_library' returns just
+	## the file name (and might launch 'ldconfig' or 'gcc' to get it), so it's not used there
+	if platform[:3] not in ["dar", "win"]:
+		return None
+	try:
+		import ctypes.util
+		lib_path = ctypes.util.find_library(lib_name)
+	except:
+		return None
+	if (lib_path is not None) and os.path.isabs(lib_path):
+		return lib_path
+	return None
+
+def _flags_from_symbols(has_symbol):
+	## Identifies the library from the presence of some symbols
+	if has_symbol('openblas_get_config'):
+		return ["HAS_OPENBLAS", "HAS_UNDERSCORES"]
+	if has_symbol('mkl_dcsrgemv'):
+		return ["HAS_MKL"]
+	if has_symbol('ddot_'):
+		found_syms = ["HAS_UNDERSCORES"]
+		if not has_symbol('cblas_ddot'):
+			found_syms += ['NO_CBLAS']
+		return found_syms
+	if has_symbol('cblas_ddot'):
+		return []
+	if has_symbol('ddot') or has_symbol('DDOT'):
+		return ["NO_CBLAS"]
+	return None
 
 def _try_add_from_command(str_expr, candidate_paths):
 	try:
-		exec("candidate_paths += " + str_expr)
+		exec("candidate_paths += " + str_expr, _import_optional_modules(), {"candidate_paths" : candidate_paths})
 	except:
 		pass
 
+def _import_optional_modules():
+	## Namespace with numpy and scipy (if installed) for the expressions in '_try_add_from_command'
+	global _optional_modules
+	if _optional_modules is None:
+		modules = {"os" : os}
+		try:
+			import numpy as np
+			modules["np"] = np
+			modules["numpy"] = np
+			import numpy.distutils.system_info
+		except:
+			pass
+		try:
+			import scipy
+			modules["scipy"] = scipy
+			import scipy.linalg
+		except:
+			pass
+		_optional_modules = modules
+	return _optional_modules
+
+def _import_elffile():
+	## Raises ImportError if pyelftools is not installed - the failed import is not retried
+	global _elffile_class
+	if _elffile_class is None:
+		try:
+			from elftools.elf.elffile import ELFFile
+			_elffile_class = ELFFile
+		except ImportError:
+			_elffile_class = False
+	if _elffile_class is False:
+		raise ImportError("pyelftools is not installed")
+	return _elffile_class
+
+def _find_symbols_elf(pt, fname):
+	ELFFile = _import_elffile()
+	with open(os.path.join(pt, fname), 'rb') as f:
+		elffile = ELFFile(f)
+		## exported symbols can be looked up through the hash table, as the dynamic linker does -
+		## unlike '.gnu.hash', a '.hash' table also has the undefined (imported) symbols
+		hash_section = elffile.get_section_by_name('.gnu.hash')
+		if hash_section is None:
+			hash_section = elffile.get_section_by_name('.hash')
+		if (hash_section is not None) and hasattr(hash_section, 'get_symbol'):
+			def has_symbol(sym_name):
+				sym = hash_section.get_symbol(sym_name)
+				return (sym is not None) and (sym['st_shndx'] != 'SHN_UNDEF')
+			return True, _flags_from_symbols(has_symbol)
+
+		## otherwise, read all the symbol names in one pass - like 'nm --defined-only' below,
+		## symbols that the library imports from elsewhere are not counted
+		symtab = elffile.get_section_by_name('.symtab')
+		if symtab is None:
+			## stripped libraries only keep the dynamic symbols
+			symtab = elffile.get_section_by_name('.dynsym')
+		sym_names = set(sym.name for sym in symtab.iter_symbols() if sym['st_shndx'] != 'SHN_UNDEF')
+	return True, _flags_from_symbols(sym_names.__contains__)
+
 def _find_symbols(pt, fname):
-	try:
-		from elftools.elf.elffile import ELFFile
-		with open(os.path.join(pt, fname), 'rb') as f:
-			elffile = ELFFile(f)
-			symtab = elffile.get_section_by_name('.symtab')
-			if symtab.get_symbol_by_name('openblas_get_config') is not None:
-				return True, ["HAS_OPENBLAS", "HAS_UNDERSCORES"]
-			if symtab.get_symbol_by_name('mkl_dcsrgemv') is not None:
-				return True, ["HAS_MKL"]
-			if symtab.get_symbol_by_name('ddot_') is not None:
-				found_syms = ["HAS_UNDERSCORES"]
-				if symtab.get_symbol_by_name('cblas_ddot') is None:
-					found_syms += ['NO_CBLAS']
-				return True, found_syms
-			if symtab.get_symbol_by_name('cblas_ddot') is not None:
-				return True, []
-			if (symtab.get_symbol_by_name('ddot') is not None) or (symtab.get_symbol_by_name('DDOT') is not None):
-				return True, ["NO_CBLAS"]
-		return True, None
+	## pyelftools only understands ELF files - Mach-O files (macOS) are read with 'nm' instead
+	if platform[:3] != "dar":
+		try:
+			return _find_symbols_elf(pt, fname)
+		except:
+			pass
 
-	except:
+	try:
+		import subprocess
+		fpath = os.path.join(pt, fname)
 		try:
-			import subprocess
-			symbols = subprocess.check_output(['readelf', '-s', os.path.join(pt, fname)])
-			symbols = str(symbols).split()
-			has_cblas = False
-			has_underscores = False
-			has_ddot = False
-			for s in symbols:
-				if bool(re.search("openblas", s)):
-					return True, ["HAS_OPENBLAS", "HAS_UNDERSCORES"]
-				if bool(re.search("mkl_dcsrgemv", s)):
-					return True, ["HAS_MKL"]
-				if bool(re.search(r"ddot_[^a-z]", s)):
-					has_underscores = True
-				if bool(re.search("cblas_ddot", s)):
-					has_cblas = True
-				if bool(re.search("ddot", s)):
-					has_ddot = True
-			
-			flags_found = []
-			if not has_cblas:
-				flags_found.append("NO_CBLAS")
-			if has_underscores:
-				flags_found.append("HAS_UNDERSCORES")
-			
-			if has_ddot:
-				return True, flags_found
+			if platform[:3] == "dar":
+				## external symbols only, skipping the undefined (imported) ones
+				symbols = subprocess.check_output(['nm', '-gU', fpath], stderr=subprocess.DEVNULL)
+			elif fname.endswith(".a"):
+				symbols = subprocess.check_output(['nm', '--defined-only', fpath], stderr=subprocess.DEVNULL)
 			else:
-				return True, None
+				symbols = subprocess.check_output(['nm', '-D', '--defined-only', fpath], stderr=subprocess.DEVNULL)
 		except:
-			return False, None
+			symbols = subprocess.check_output(['readelf', '-s', fpath])
+		has_cblas = False
+		has_underscores = False
+		has_ddot = False
+		for s in symbols.splitlines():
+			## 'readelf' also lists the undefined (imported) symbols
+			if _RE_READELF_UNDEF.search(s) is not None:
+				continue
+			if _RE_OPENBLAS.search(s) is not None:
+				return True, ["HAS_OPENBLAS", "HAS_UNDERSCORES"]
+			if _RE_MKL_DCSRGEMV.search(s) is not None:
+				return True, ["HAS_MKL"]
+			if _RE_DDOT_US.search(s) is not None:
+				has_underscores = True
+			if _RE_CBLAS_DDOT.search(s) is not None:
+				has_cblas = True
+			if _RE_DDOT.search(s) is not None:
+				has_ddot = True
+		
+		flags_found = []
+		if not has_cblas:
+			flags_found.append("NO_CBLAS")
+		if has_underscores:
+			flags_found.append("HAS_UNDERSCORES")
+		
+		if has_ddot:
+			return True, flags_found
+		else:
+			return True, None
+	except:
+		return False, None
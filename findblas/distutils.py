@@ -1,165 +1,263 @@
-from Cython.Distutils import build_ext
-import findblas, re, os, sys, warnings
+## setuptools' 'build_ext' translates '.pyx' sources through Cython's when Cython is installed
+try:
+    from setuptools.command.build_ext import build_ext
+except ImportError:
+    from distutils.command.build_ext import build_ext
+import findblas, os, sys, warnings
 from sys import platform
 import platform as platform_module
+import threading, functools, tempfile
+
+_IS_WIN = platform.startswith("win")
+_IS_DARWIN = platform == "darwin"
+
+## Results of the BLAS and header lookups, per python environment
+_BLAS_CACHE = dict()
+_BLAS_CACHE_LOCK = threading.Lock()
 
 ## https://stackoverflow.com/questions/52905458/link-cython-wrapped-c-functions-against-blas-from-numpy
 class build_ext_with_blas( build_ext ):
     """
-    'build_ext' module built on top of 'Cython.Distutils.build_ext'.
+    'build_ext' module built on top of 'setuptools.command.build_ext.build_ext'.
 
     Intended to passed to 'setuptools.setup', or to 'distutils.core.setup'.
+    Cython sources ('.pyx') are supported if Cython is installed - for faster builds,
+    the extensions can be translated beforehand with 'finalize_extensions'.
     """
 
     def build_extensions(self):
-        ## Lookup blas files and headers first
-        nocblas_err_msg  = "\n\nNo CBLAS library found - please install one with e.g. "
-        nocblas_err_msg += "'sudo apt-get install libopenblas-dev' (or 'intel-mkl-full') (Debian/Ubuntu)"
-        nocblas_err_msg += ", 'conda install mkl-devel' (Linux / Mac)"
-        nocblas_err_msg += ", or 'pip install mkl-devel' (Windows / Linux / Mac)."
         from_rtd = os.environ.get('READTHEDOCS') == 'True'
+        ## The lookup is done only once per python environment, even if there are many
+        ## extensions or the command runs many times
+        cache_key = (sys.prefix, platform, os.environ.get('READTHEDOCS'))
+        with _BLAS_CACHE_LOCK:
+            if cache_key not in _BLAS_CACHE:
+                _BLAS_CACHE[cache_key] = _lookup_blas_and_header(from_rtd)
+            blas_path, blas_file, incl_path, incl_file, flags, finblas_head_fold = _BLAS_CACHE[cache_key]
+        flags = list(flags)
+
+        ## The arguments are the same for all the extensions
+        blas_link_args = []
+        blas_sources = []
+        is_msvc = self.compiler.compiler_type == 'msvc'
         if not from_rtd:
-            blas_path, blas_file, incl_path, incl_file, flags = findblas.find_blas()
-            if (blas_file is None) or (blas_path is None):
-                raise ValueError(nocblas_err_msg)
-            elif blas_file == "mkl_rt.dll":
-                txt = "Found MKL library at:\n" + os.path.join(blas_path, blas_file)
-                txt += "\nHowever, it is missing .lib files - please install them with 'pip install mkl-devel'."
-                raise ValueError(txt)
-            elif bool(re.search(r"\.dll$", blas_file)):
-                txt = "Found BLAS library at:\n" + os.path.join(blas_path, blas_file)
-                txt += "\nBut .lib files are missing! Please reinstall it (e.g. 'pip install mkl-devel')."
-                raise ValueError(txt)
-            else:
-            	if platform[:3] != "win":
-                	print("Installation: Using BLAS library found in:\n" + os.path.join(blas_path, blas_file) + "\n\n")
+            if is_msvc: # visual studio
+                ## '.lib' files are passed by name plus a search folder rather than as a full path, so that
+                ## the linker resolves them like any other library - other files (e.g. 'libopenblas.dll.a')
+                ## are taken as object files, which are not looked up in '/LIBPATH:' folders.
+                ## '/OPT:REF' and '/OPT:ICF' drop and fold unused code - note that they make links slower,
+                ## and are incompatible with incremental linking (which distutils already disables).
+                if blas_file.endswith(".lib"):
+                    blas_link_args += ['/LIBPATH:' + blas_path, blas_file]
+                else:
+                    blas_link_args += [os.path.join(blas_path, blas_file)]
+                blas_link_args += ['/OPT:REF', '/OPT:ICF']
+            else: # everything else which cares about following standards
+                if not _IS_DARWIN:
+                    blas_link_args += ["-L" + blas_path, "-l:" + blas_file]
+                else:
+                    blas_shortened = _shorten_lib_name(blas_file)
+                    blas_link_args += ["-L" + blas_path, "-l" + blas_shortened]
+                if blas_file.endswith(".a"):
+                    if "gsl" in blas_file:
+                        blas_link_args += ["-lgslcblas"]
+                    else:
+                        blas_link_args += ["-lcblas", "-lblas"]
+                else:
+                    if _IS_DARWIN:
+                        blas_link_args += ["-Wl,-rpath," + blas_path]
+                    else:
+                        blas_link_args += ["-Wl,-rpath=" + blas_path]
+
         else:
-            flags = ['_FOR_RTD']
-            blas_path, blas_file, incl_path, incl_file = [None]*4
+            blas_sources.append(os.path.join(finblas_head_fold, "rtd_mock.c"))
+        ## The flags go in a generated header which 'findblas.h' includes, so that only
+        ## one macro needs to be passed in the command line of each source file
+        blas_macros = [('FINDBLAS_CONFIG', None)]
+        blas_include_dirs = [incl_path] if incl_path is not None else []
+        blas_include_dirs.append(finblas_head_fold)
+        blas_include_dirs.append(_write_config_header(self.build_temp, flags))
 
-        ## if no CBLAS and no functions are present, there will be no prototypes for the cblas API
-        if "NO_CBLAS" in flags:
+        ## Optimization flags for the code that calls BLAS - none are added in debug builds, and the
+        ## default level is skipped if the user already passed one through 'CFLAGS' ('CL' in MSVC),
+        ## as those go before the extensions' arguments in the command line and would be overridden.
+        ## Non-portable or value-changing flags are only added with 'FINDBLAS_NATIVE=1', as they
+        ## would otherwise break shared wheels
+        build_native = os.environ.get('FINDBLAS_NATIVE', '0') not in ['', '0']
+        opt_compile_args = []
+        opt_link_args = []
+        if not self.debug:
+            if is_msvc:
+                if not _has_opt_level(os.environ.get('CL', '')):
+                    opt_compile_args += ['/O2']
+                if build_native:
+                    opt_compile_args += ['/fp:fast', '/GL']
+                    opt_link_args += ['/LTCG']
+            else:
+                if not _has_opt_level(os.environ.get('CFLAGS', '')):
+                    opt_compile_args += ['-O3', '-funroll-loops']
+                if build_native:
+                    opt_compile_args += ['-march=native', '-ffast-math', '-flto']
+                    opt_link_args += ['-flto']
+
+        ## Now add them to the extension
+        for e in self.extensions:
+            ## the same extension objects get reused if the command runs many times
+            ## (e.g. 'develop' followed by 'build_ext --inplace')
+            if getattr(e, '_findblas_patched', False):
+                continue
+            e._findblas_patched = True
+            ## these go first, so that the extensions' own arguments (e.g. added in a subclass) take precedence
+            e.extra_compile_args[:0] = opt_compile_args
+            e.extra_link_args[:0] = opt_link_args
+            e.extra_link_args.extend(blas_link_args)
+            e.sources.extend(blas_sources)
+            e.define_macros.extend(blas_macros)
+            e.include_dirs = list(dict.fromkeys(e.include_dirs + blas_include_dirs))
+
+        build_ext.build_extensions(self)
+
+def _lookup_blas_and_header(from_rtd):
+    ## Lookup blas files and headers first
+    nocblas_err_msg  = "\n\nNo CBLAS library found - please install one with e.g. "
+    nocblas_err_msg += "'sudo apt-get install libopenblas-dev' (or 'intel-mkl-full') (Debian/Ubuntu)"
+    nocblas_err_msg += ", 'conda install mkl-devel' (Linux / Mac)"
+    nocblas_err_msg += ", or 'pip install mkl-devel' (Windows / Linux / Mac)."
+    if not from_rtd:
+        blas_path, blas_file, incl_path, incl_file, flags = findblas.find_blas()
+        if (blas_file is None) or (blas_path is None):
             raise ValueError(nocblas_err_msg)
+        elif blas_file == "mkl_rt.dll":
+            txt = "Found MKL library at:\n" + os.path.join(blas_path, blas_file)
+            txt += "\nHowever, it is missing .lib files - please install them with 'pip install mkl-devel'."
+            raise ValueError(txt)
+        elif blas_file.endswith(".dll"):
+            txt = "Found BLAS library at:\n" + os.path.join(blas_path, blas_file)
+            txt += "\nBut .lib files are missing! Please reinstall it (e.g. 'pip install mkl-devel')."
+            raise ValueError(txt)
+        else:
+            if not _IS_WIN:
+                print("Installation: Using BLAS library found in:\n" + os.path.join(blas_path, blas_file) + "\n\n")
+    else:
+        flags = ['_FOR_RTD']
+        blas_path, blas_file, incl_path, incl_file = [None]*4
 
-        ## Add findblas' header
-        ## if installing with pip or setuptools, will be here (this is the ideal case)
-        if os.path.exists(re.sub(r"__init__\.py$", "findblas.h", findblas.__file__)):
-            finblas_head_fold = re.sub(r"__init__\.py$", "", findblas.__file__)
+    ## if no CBLAS and no functions are present, there will be no prototypes for the cblas API
+    if "NO_CBLAS" in flags:
+        raise ValueError(nocblas_err_msg)
 
-        ## if installing with distutils, will be placed here (this should ideally not happen)
-        elif os.path.exists(os.path.join(sys.prefix, "include", "findblas.h")):
-            finblas_head_fold = os.path.join(sys.prefix, "include")
+    ## Add findblas' header - it is only looked for when the mock sources are needed, as
+    ## otherwise the package's own folder is passed to the compiler as-is
+    if from_rtd:
+        finblas_head_fold = _resolve_header_dir()
+    else:
+        finblas_head_fold = os.path.dirname(os.path.abspath(findblas.__file__))
 
-        elif os.path.exists(os.path.join(sys.prefix, "findblas.h")):
-            finblas_head_fold = sys.prefix
+    ## Pass extra flags for the header
+    warning_msg = "No CBLAS headers were found - function propotypes might be unreliable."
+    mkl_err_msg = "Missing MKL CBLAS headers, please reinstall with e.g. 'conda install mkl-include' or 'pip install mkl-include'."
+    gsl_err_msg = "Missing GSL CBLAS headers, please reinstall with e.g. 'conda install gsl'."
+    if incl_file == "mkl_cblas.h":
+        flags.append("MKL_OWN_INCL_CBLAS")
+    elif incl_file == "mkl_blas.h":
+        raise ValueError(mkl_err_msg)
+    elif incl_file == "cblas-openblas.h":
+        flags.append("OPENBLAS_OWN_INCL")
+    elif incl_file == "gsl_cblas.h":
+        flags.append("GSL_OWN_INCL_CBLAS")
+    elif incl_file == "gsl_blas.h":
+        raise ValueError(gsl_err_msg)
+    elif incl_file == "INCL_CBLAS":
+        flags.append("INCL_CBLAS")
+    elif incl_file == "blas.h":
+        flags.append("INCL_BLAS")
+        warnings.warn(warning_msg)
+    elif (incl_path is None) or (incl_file is None):
+        flags.append("NO_CBLAS_HEADER")
+        warnings.warn(warning_msg)
+    else:
+        pass
 
-        ## if on a PEP518 environment, might be located elsewhere
-        else:
-            candidate_paths = [sys.prefix]
-            try:
-                candidate_paths.append(os.environ['PYTHONPATH'])
-            except:
-                pass
-            if platform[:3] == "win":
-                candidate_paths += os.environ['PATH'].split(";")
-            else:
-                candidate_paths += os.environ['PATH'].split(":")
-
-            for path in candidate_paths:
-                if bool(re.search(r"[Oo]verlay", path)):
-                    clean_path = re.sub(r"^(.*[Oo]verlay).*$", r"\1", path)
-                    if os.path.exists( os.path.join(clean_path, "include", "findblas.h") ):
-                        finblas_head_fold = os.path.join(clean_path, "include")
-                        break
-                    elif os.path.exists( os.path.join(clean_path, "findblas.h") ):
-                        finblas_head_fold = clean_path
-                        break
-                    elif os.path.exists( os.path.join(clean_path, "site-packages", "findblas", "findblas.h") ):
-                        finblas_head_fold = os.path.join(clean_path, "site-packages", "findblas")
-                        break
-                    elif os.path.exists( os.path.join(clean_path, "Lib", "site-packages", "findblas", "findblas.h") ):
-                        finblas_head_fold = os.path.join(clean_path, "Lib", "site-packages", "findblas")
-                        break
-                    elif os.path.exists( os.path.join(clean_path, "lib", "site-packages", "findblas", "findblas.h") ):
-                        finblas_head_fold = os.path.join(clean_path, "lib", "site-packages", "findblas")
-                        break
-
-            ## if still not found, try to get it from pip itself
-            else:
-                import pip
-                import io
-                from contextlib import redirect_stdout
-                pip_outp = io.StringIO()
-                with redirect_stdout(pip_outp):
-                    pip.main(['show', '-f', 'findblas'])
-                pip_outp = pip_outp.getvalue()
-                pip_outp = pip_outp.split("\n")
-                for ln in pip_outp:
-                    if bool(re.search(r"^Location", ln)):
-                        files_root = re.sub(r"^Location:\s+", "", ln)
-                        break
-                for ln in pip_outp:
-                    if bool(re.search(r"findblas\.h$", ln)):
-                        finblas_head_fold = os.path.join(files_root, re.sub(r"^(.*)[/\\]*findblas\.h$", r"\1", ln))
-                        break
-
-                ## if the header file doesn't exist, shall raise en error
-                else:
-                    raise ValueError("Could not find header file from 'findblas' - please try reinstalling with 'pip install --force findblas'")
-
-        ## Pass extra flags for the header
-        warning_msg = "No CBLAS headers were found - function propotypes might be unreliable."
-        mkl_err_msg = "Missing MKL CBLAS headers, please reinstall with e.g. 'conda install mkl-include' or 'pip install mkl-include'."
-        gsl_err_msg = "Missing GSL CBLAS headers, please reinstall with e.g. 'conda install gsl'."
-        if incl_file == "mkl_cblas.h":
-            flags.append("MKL_OWN_INCL_CBLAS")
-        elif incl_file == "mkl_blas.h":
-            raise ValueError(mkl_err_msg)
-        elif incl_file == "cblas-openblas.h":
-            flags.append("OPENBLAS_OWN_INCL")
-        elif incl_file == "gsl_cblas.h":
-            flags.append("GSL_OWN_INCL_CBLAS")
-        elif incl_file == "gsl_blas.h":
-            raise ValueError(gsl_err_msg)
-        elif incl_file == "INCL_CBLAS":
-            flags.append("INCL_CBLAS")
-        elif incl_file == "blas.h":
-            flags.append("INCL_BLAS")
-            warnings.warn(warning_msg)
-        elif (incl_path is None) or (incl_file is None):
-            flags.append("NO_CBLAS_HEADER")
-            warnings.warn(warning_msg)
-        else:
-            pass
+    return blas_path, blas_file, incl_path, incl_file, flags, finblas_head_fold
 
-        ## Now add them to the extension
-        for e in self.extensions:
-            if not from_rtd:
-                if self.compiler.compiler_type == 'msvc': # visual studio
-                    e.extra_link_args += [os.path.join(blas_path, blas_file)]
-                else: # everything else which cares about following standards
-                    if platform[:3] != "dar":
-                        e.extra_link_args += ["-L" + blas_path, "-l:" + blas_file]
-                    else:
-                        blas_shortened = re.sub(r"^lib", "", blas_file)
-                        blas_shortened = re.sub(r"\.[A-Za-z]+$", "", blas_shortened)
-                        e.extra_link_args += ["-L" + blas_path, "-l" + blas_shortened]
-                    if bool(re.search(r"\.a$", blas_file)):
-                        if (bool(re.search(r"gsl", blas_file))):
-                            e.extra_link_args += ["-lgslcblas"]
-                        else:
-                            e.extra_link_args += ["-lcblas", "-lblas"]
-                    else:
-                        if platform[:3] == "dar":
-                            e.extra_link_args += ["-Wl,-rpath," + blas_path]
-                        else:
-                            e.extra_link_args += ["-Wl,-rpath=" + blas_path]
+def _write_config_header(build_temp, flags):
+    ## Generates 'findblas_config.h' under the build folder and returns the folder where it is.
+    ## It is not placed next to 'findblas.h', as that folder might be shared across projects
+    ## or not writable. The file is left untouched if its contents would not change, and is
+    ## otherwise replaced atomically in case there are parallel builds.
+    config_dir = os.path.join(build_temp, "findblas")
+    config_file = os.path.join(config_dir, "findblas_config.h")
+    contents  = "#ifndef FINDBLAS_CONFIG_H\n#define FINDBLAS_CONFIG_H\n"
+    contents += "".join("#define " + f + "\n" for f in flags)
+    contents += "#endif /* FINDBLAS_CONFIG_H */\n"
+    try:
+        with open(config_file, "r") as f:
+            if f.read() == contents:
+                return config_dir
+    except OSError:
+        pass
 
-            else:
-                e.sources.append(os.path.join(finblas_head_fold, "rtd_mock.c"))
-            e.define_macros += [(f, None) for f in flags]
-            if incl_path is not None:
-                e.include_dirs.append(incl_path)
-            e.include_dirs.append(finblas_head_fold)
+    os.makedirs(config_dir, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(suffix=".tmp", prefix="findblas_config.h.", dir=config_dir)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(contents)
+        os.replace(temp_file, config_file)
+    except:
+        os.unlink(temp_file)
+        raise
+    return config_dir
 
-        build_ext.build_extensions(self)
+@functools.lru_cache(maxsize=None)
+def _resolve_header_dir():
+    ## if installing with pip or setuptools, will be next to the package,
+    ## while 'data_files' additionally places it under the python prefix
+    pkg_dir = os.path.dirname(os.path.abspath(findblas.__file__))
+    for candidate in (pkg_dir, os.path.join(sys.prefix, "include"), sys.prefix):
+        if os.path.isfile(os.path.join(candidate, "findblas.h")):
+            return candidate
+    raise ValueError("findblas.h not found; reinstall findblas")
+
+def _shorten_lib_name(blas_file):
+    ## e.g. 'libopenblas.dylib' -> 'openblas', for passing it as '-lopenblas'
+    if blas_file.startswith("lib"):
+        blas_file = blas_file[len("lib"):]
+    file_root, file_ext = os.path.splitext(blas_file)
+    if file_ext[1:].isalpha():
+        blas_file = file_root
+    return blas_file
+
+def finalize_extensions(extensions, nthreads=None, language_level=3, **kwargs):
+    """
+    Translate Cython extensions to C in parallel
+
+    Runs 'Cython.Build.cythonize' on the extensions, using all the available CPU cores by default.
+    The result should be passed as 'ext_modules' to 'setuptools.setup', along with 'build_ext_with_blas'.
+
+    Note that, in Windows, running in parallel requires the call to 'setup' to be under
+    an 'if __name__ == "__main__":' guard.
+
+    Parameters
+    ----------
+    extensions : list
+        Extensions (e.g. 'setuptools.Extension') with '.pyx' sources.
+    nthreads : int or None
+        Number of parallel jobs. If None, will use the number of CPU cores.
+    language_level : int
+        Python language level for Cython.
+    **kwargs
+        Additional arguments to pass to 'cythonize' (e.g. 'compiler_directives').
+
+    Returns
+    -------
+    extensions : list
+        Extensions with their Cython sources translated to C/C++.
+    """
+    from Cython.Build import cythonize
+    if nthreads is None:
+        nthreads = os.cpu_count() or 1
+    return cythonize(extensions, nthreads=nthreads, language_level=language_level, **kwargs)
+
+def _has_opt_level(user_flags):
+    ## e.g. '-O2' in 'CFLAGS', or '/Od' in MSVC's 'CL'
+    return any(flag.startswith(("-O", "/O")) for flag in user_flags.split())
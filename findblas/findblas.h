@@ -8,6 +8,11 @@
 	header for you, or will declare the basic functions if no header is present.
 	*/
 
+/*	Flags from 'build_ext_with_blas', which are generated in a separate header */
+#ifdef FINDBLAS_CONFIG
+  #include "findblas_config.h"
+#endif
+
 #if defined MKL_OWN_INCL_CBLAS
   #include "mkl_cblas.h"
 #elif defined(USE_MKL) && !defined(NO_CBLAS_HEADER)
@@ -1,15 +1,12 @@
-try:
-	from setuptools import setup
-except:
-	from distutils.core import setup
+## Package metadata is declared in 'pyproject.toml' - the header is additionally
+## placed under 'include', for environments where the package folder is not reachable.
+## setuptools is only imported when this file is run, not when it is merely imported.
+if __name__ == "__main__":
+	try:
+		from setuptools import setup
+	except:
+		from distutils.core import setup
 
-setup(
-  name = 'findblas',
-  packages = ['findblas'],
-  version = '0.1.18',
-  author = 'David Cortes',
-  url = 'https://github.com/david-cortes/findblas',
-  classifiers = [],
-  data_files=[('include', ['findblas/findblas.h', 'findblas/rtd_mock.c'])],
-  include_package_data=True
-) 
+	setup(
+	  data_files=[('include', ['findblas/findblas.h', 'findblas/rtd_mock.c'])]
+	)